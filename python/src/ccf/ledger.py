@@ -399,7 +399,12 @@ class SimpleBuffer:
 
     @staticmethod
     def from_file(filename):
-        return SimpleBuffer(filename, open(filename, "rb").read())
+        with open(filename, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                # The whole file is read front-to-back, so let the kernel
+                # use a larger readahead window
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return SimpleBuffer(filename, f.read())
 
 
 def _byte_read_safe(file: SimpleBuffer, num_of_bytes):
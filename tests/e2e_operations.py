@@ -2,6 +2,8 @@
 # Licensed under the Apache 2.0 License.
 import tempfile
 import os
+import collections
+import mmap
 import signal
 import shutil
 import urllib.parse
@@ -39,6 +41,7 @@ import infra.utils
 import re
 import hashlib
 from contextlib import contextmanager
+from concurrent import futures
 
 from loguru import logger as LOG
 
@@ -53,13 +56,12 @@ def test_save_committed_ledger_files(network, args):
 
     LOG.info(f"Moving committed ledger files to {args.common_read_only_ledger_dir}")
     primary, _ = network.find_primary()
+    read_only_ledger_dir_prefix = os.path.join(args.common_read_only_ledger_dir, "")
     for ledger_dir in primary.remote.ledger_paths():
-        for ledger_file_path in os.listdir(ledger_dir):
-            if infra.node.is_file_committed(ledger_file_path):
-                shutil.move(
-                    os.path.join(ledger_dir, ledger_file_path),
-                    os.path.join(args.common_read_only_ledger_dir, ledger_file_path),
-                )
+        with os.scandir(ledger_dir) as entries:
+            for entry in entries:
+                if ccf.ledger.is_ledger_chunk_committed(entry.name):
+                    shutil.move(entry.path, read_only_ledger_dir_prefix + entry.name)
 
     network.txs.verify(network)
     return network
@@ -78,19 +80,20 @@ def test_parse_snapshot_file(network, args):
         def run(self):
             seen = set()
             while not self.is_stopped():
-                for snapshot in os.listdir(self.snapshots_dir):
-                    if (
-                        ccf.ledger.is_snapshot_file_committed(snapshot)
-                        and snapshot not in seen
-                    ):
-                        seen.add(snapshot)
-                        with ccf.ledger.Snapshot(
-                            os.path.join(self.snapshots_dir, snapshot)
-                        ) as s:
-                            assert len(
-                                s.get_public_domain().get_tables()
-                            ), "No public table in snapshot"
-                            LOG.success(f"Successfully parsed snapshot: {snapshot}")
+                with os.scandir(self.snapshots_dir) as entries:
+                    for entry in entries:
+                        if (
+                            ccf.ledger.is_snapshot_file_committed(entry.name)
+                            and entry.name not in seen
+                        ):
+                            seen.add(entry.name)
+                            with ccf.ledger.Snapshot(entry.path) as s:
+                                assert len(
+                                    s.get_public_domain().get_tables()
+                                ), "No public table in snapshot"
+                                LOG.success(
+                                    f"Successfully parsed snapshot: {entry.name}"
+                                )
             LOG.info(f"Tested {len(seen)} snapshots")
             assert len(seen) > 0, "No snapshots seen, so this tested nothing"
 
@@ -126,19 +129,26 @@ def test_parse_snapshot_file(network, args):
 
 
 def find_ledger_chunk_for_seqno(ledger, seqno):
-    for chunk in ledger:
+    # Chunks are ordered by seqno, so binary search for the one containing
+    # seqno rather than parsing every chunk in the ledger
+    lo, hi = 0, len(ledger)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        chunk = ledger[mid]
         first, last = chunk.get_seqnos()
-        next_signature = None
-        for tx in chunk:
-            pd = tx.get_public_domain()
-            tables = pd.get_tables()
-            if (
-                pd.get_seqno() >= seqno
-                and next_signature is None
-                and ccf.ledger.SIGNATURE_TX_TABLE_NAME in tables
-            ):
-                next_signature = pd.get_seqno()
-        if first <= seqno and seqno <= last:
+        if seqno < first:
+            hi = mid
+        elif last is not None and seqno > last:
+            lo = mid + 1
+        else:
+            next_signature = None
+            for tx in chunk:
+                pd = tx.get_public_domain()
+                if pd.get_seqno() < seqno:
+                    continue
+                if ccf.ledger.SIGNATURE_TX_TABLE_NAME in pd.get_tables():
+                    next_signature = pd.get_seqno()
+                    break
             return chunk, first, last, next_signature
     return None, None, None, None
 
@@ -175,14 +185,15 @@ def test_forced_ledger_chunk(network, args):
 
 
 def find_snapshot_after_seqno(snapshots_dir, seqno):
-    for snapshot_name in os.listdir(snapshots_dir):
-        with ccf.ledger.Snapshot(
-            os.path.join(snapshots_dir, snapshot_name)
-        ) as snapshot:
-            snapshot_seqno = snapshot.get_public_domain().get_seqno()
-            if snapshot_seqno > seqno:
-                LOG.info(f"Found a snapshot at {snapshot_seqno} which is after {seqno}")
-                return snapshot_seqno
+    with os.scandir(snapshots_dir) as entries:
+        for entry in entries:
+            with ccf.ledger.Snapshot(entry.path) as snapshot:
+                snapshot_seqno = snapshot.get_public_domain().get_seqno()
+                if snapshot_seqno > seqno:
+                    LOG.info(
+                        f"Found a snapshot at {snapshot_seqno} which is after {seqno}"
+                    )
+                    return snapshot_seqno
 
     raise RuntimeError(
         f"Could not find a snapshot after seqno {seqno} in {snapshots_dir}"
@@ -259,13 +270,29 @@ def test_large_snapshot(network, args):
     entry_size = 10000  # Lower bound on serialised write set size
     iterations = int(args.max_msg_size_bytes) // entry_size
     LOG.debug(f"Recording {iterations} large entries")
-    with primary.client(identity="user0") as c:
-        for idx in range(iterations):
-            c.post(
-                "/app/log/public?scope=test_large_snapshot",
-                body={"id": idx, "msg": "X" * entry_size},
-                log_capture=[],
+    msg = "X" * entry_size
+
+    def record_entries(indices):
+        with primary.client(identity="user0") as c:
+            for idx in indices:
+                c.post(
+                    "/app/log/public?scope=test_large_snapshot",
+                    body={"id": idx, "msg": msg},
+                    log_capture=[],
+                )
+
+    # Entries are independent, so submit them from several concurrent clients
+    concurrent_clients = 8
+    with futures.ThreadPoolExecutor(max_workers=concurrent_clients) as executor:
+        list(
+            executor.map(
+                record_entries,
+                [
+                    range(i, iterations, concurrent_clients)
+                    for i in range(concurrent_clients)
+                ],
             )
+        )
 
     # Force a snapshot at the following signature
     primary.trigger_snapshot()
@@ -273,16 +300,17 @@ def test_large_snapshot(network, args):
     # Check that there is at least a snapshot larger than args.max_msg_size_bytes
     snapshots_dir = network.get_committed_snapshots(primary)
     extra_data_size_bytes = 10000  # Upper bound on additional snapshot data (e.g. receipt) that is passed separately from the snapshot
-    for s in os.listdir(snapshots_dir):
-        snapshot_size = os.stat(os.path.join(snapshots_dir, s)).st_size
-        if snapshot_size > int(args.max_msg_size_bytes) + extra_data_size_bytes:
-            # Make sure that large snapshot can be parsed
-            snapshot = ccf.ledger.Snapshot(os.path.join(snapshots_dir, s))
-            assert snapshot.get_len() == snapshot_size
-            LOG.info(
-                f"Found snapshot [{snapshot_size}] larger than ring buffer max msg size {args.max_msg_size_bytes}"
-            )
-            return network
+    with os.scandir(snapshots_dir) as entries:
+        for entry in entries:
+            snapshot_size = entry.stat().st_size
+            if snapshot_size > int(args.max_msg_size_bytes) + extra_data_size_bytes:
+                # Make sure that large snapshot can be parsed
+                snapshot = ccf.ledger.Snapshot(entry.path)
+                assert snapshot.get_len() == snapshot_size
+                LOG.info(
+                    f"Found snapshot [{snapshot_size}] larger than ring buffer max msg size {args.max_msg_size_bytes}"
+                )
+                return network
 
     raise RuntimeError(
         f"Could not find any snapshot file larger than {args.max_msg_size_bytes}"
@@ -296,8 +324,12 @@ def test_snapshot_access(network, args):
     snapshot_name = ccf.ledger.latest_snapshot(snapshots_dir)
     snapshot_index, _ = ccf.ledger.snapshot_index_from_filename(snapshot_name)
 
+    # Map the snapshot rather than reading it into memory, so that only the
+    # ranges compared below are paged in
     with open(os.path.join(snapshots_dir, snapshot_name), "rb") as f:
-        snapshot_data = f.read()
+        snapshot_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Compare against views of the mapping, to avoid copying each range
+    snapshot_view = memoryview(snapshot_data)
 
     for node in (primary, *backups):
         with node.client(interface_name=infra.interfaces.PRIMARY_RPC_INTERFACE) as c:
@@ -309,66 +341,103 @@ def test_snapshot_access(network, args):
     interface = primary.host.rpc_interfaces[infra.interfaces.FILE_SERVING_RPC_INTERFACE]
     loc = f"https://{interface.public_host}:{interface.public_port}"
 
-    with primary.client(
-        interface_name=infra.interfaces.FILE_SERVING_RPC_INTERFACE
-    ) as file_client:
+    @contextmanager
+    def file_request_client():
         with primary.client(
-            interface_name=infra.interfaces.PRIMARY_RPC_INTERFACE
-        ) as disabled_client:
+            interface_name=infra.interfaces.FILE_SERVING_RPC_INTERFACE
+        ) as file_client:
+            with primary.client(
+                interface_name=infra.interfaces.PRIMARY_RPC_INTERFACE
+            ) as disabled_client:
+
+                def do_request(http_verb, *args, **kwargs):
+                    r = disabled_client.call(*args, http_verb=http_verb, **kwargs)
+                    assert (
+                        r.status_code == http.HTTPStatus.NOT_FOUND
+                    ), f"Expected inaccessible due to disabled opt-in feature. Found:\n{r}"
+                    return file_client.call(*args, http_verb=http_verb, **kwargs)
+
+                yield do_request
+
+    with file_request_client() as do_request:
+        r = do_request("HEAD", "/node/snapshot", allow_redirects=False)
+        assert r.status_code == http.HTTPStatus.PERMANENT_REDIRECT.value, r
+        assert "location" in r.headers, r.headers
+        location = r.headers["location"]
+        path = f"/node/snapshot/{snapshot_name}"
+        assert location == f"{loc}{path}"
+        LOG.warning(r.headers)
+
+        # since uses closed/inclusive semantics: since=N returns snapshots
+        # with index >= N. So since=snapshot_index returns the snapshot
+        # (inclusive boundary), while since=snapshot_index+1 does not
+        # (strictly past the available snapshot index).
+        for since, expected in (
+            (0, location),
+            (1, location),
+            (snapshot_index // 2, location),
+            (snapshot_index - 1, location),
+            (snapshot_index, location),  # inclusive: exact index is returned
+            (snapshot_index + 1, None),  # strictly past: nothing returned
+        ):
+            for method in ("GET", "HEAD"):
+                r = do_request(
+                    method,
+                    f"/node/snapshot?since={since}",
+                    allow_redirects=False,
+                )
+                if expected is None:
+                    assert r.status_code == http.HTTPStatus.NOT_FOUND, r
+                else:
+                    assert r.status_code == http.HTTPStatus.PERMANENT_REDIRECT.value, r
+                    assert "location" in r.headers, r.headers
+                    actual = r.headers["location"]
+                    assert actual == expected
+
+        r = do_request("HEAD", path)
+        assert r.status_code == http.HTTPStatus.OK.value, r
+        assert r.headers["accept-ranges"] == "bytes", r.headers
+        total_size = int(r.headers["content-length"])
+
+        # Use HTTP-style inclusive range end value
+        range_max = total_size - 1
 
-            def do_request(http_verb, *args, **kwargs):
-                r = disabled_client.call(*args, http_verb=http_verb, **kwargs)
+        def check_range(request_fn, start, end):
+            range_header_value = f"{start}-{'' if end is None else end}"
+            r = request_fn(
+                "GET", path, headers={"range": f"bytes={range_header_value}"}
+            )
+            assert r.status_code == http.HTTPStatus.PARTIAL_CONTENT.value, r
+            headers = r.headers
+            implied_end = range_max if end is None else end
+            assert int(headers["content-length"]) == implied_end - start + 1
+            assert (
+                headers["content-range"] == f"bytes {start}-{implied_end}/{total_size}"
+            )
+
+            actual = r.body.data()
+            with snapshot_view[start : (None if end is None else end + 1)] as expected:
                 assert (
-                    r.status_code == http.HTTPStatus.NOT_FOUND
-                ), f"Expected inaccessible due to disabled opt-in feature. Found:\n{r}"
-                return file_client.call(*args, http_verb=http_verb, **kwargs)
+                    expected == actual
+                ), f"Binary mismatch, {len(expected)} vs {len(actual)}:\n{bytes(expected)}\nvs\n{actual}"
 
-            r = do_request("HEAD", "/node/snapshot", allow_redirects=False)
-            assert r.status_code == http.HTTPStatus.PERMANENT_REDIRECT.value, r
-            assert "location" in r.headers, r.headers
-            location = r.headers["location"]
-            path = f"/node/snapshot/{snapshot_name}"
-            assert location == f"{loc}{path}"
-            LOG.warning(r.headers)
-
-            # since uses closed/inclusive semantics: since=N returns snapshots
-            # with index >= N. So since=snapshot_index returns the snapshot
-            # (inclusive boundary), while since=snapshot_index+1 does not
-            # (strictly past the available snapshot index).
-            for since, expected in (
-                (0, location),
-                (1, location),
-                (snapshot_index // 2, location),
-                (snapshot_index - 1, location),
-                (snapshot_index, location),  # inclusive: exact index is returned
-                (snapshot_index + 1, None),  # strictly past: nothing returned
-            ):
-                for method in ("GET", "HEAD"):
-                    r = do_request(
-                        method,
-                        f"/node/snapshot?since={since}",
-                        allow_redirects=False,
-                    )
-                    if expected is None:
-                        assert r.status_code == http.HTTPStatus.NOT_FOUND, r
-                    else:
-                        assert (
-                            r.status_code == http.HTTPStatus.PERMANENT_REDIRECT.value
-                        ), r
-                        assert "location" in r.headers, r.headers
-                        actual = r.headers["location"]
-                        assert actual == expected
-
-            r = do_request("HEAD", path)
-            assert r.status_code == http.HTTPStatus.OK.value, r
-            assert r.headers["accept-ranges"] == "bytes", r.headers
-            total_size = int(r.headers["content-length"])
+        def check_negative_offset(request_fn, negative_offset):
+            range_header_value = f"-{negative_offset}"
+            r = request_fn(
+                "GET", path, headers={"range": f"bytes={range_header_value}"}
+            )
+            assert r.status_code == http.HTTPStatus.PARTIAL_CONTENT.value, r
 
-            # Use HTTP-style inclusive range end value
-            range_max = total_size - 1
+            actual = r.body.data()
+            with snapshot_view[-negative_offset:] as expected:
+                assert (
+                    expected == actual
+                ), f"Binary mismatch, {len(expected)} vs {len(actual)}:\n{bytes(expected)}\nvs\n{actual}"
 
-            a = total_size // 3
-            b = a * 2
+        a = total_size // 3
+        b = a * 2
+        range_checks = [
+            (check_range, start, end)
             for start, end in [
                 (0, None),
                 (0, 0),
@@ -381,57 +450,52 @@ def test_snapshot_access(network, args):
                 (b, None),
                 (range_max, range_max),
                 (range_max, None),
-            ]:
-                range_header_value = f"{start}-{'' if end is None else end}"
-                r = do_request(
-                    "GET", path, headers={"range": f"bytes={range_header_value}"}
-                )
-                assert r.status_code == http.HTTPStatus.PARTIAL_CONTENT.value, r
-                headers = r.headers
-                implied_end = range_max if end is None else end
-                assert int(headers["content-length"]) == implied_end - start + 1
-                assert (
-                    headers["content-range"]
-                    == f"bytes {start}-{implied_end}/{total_size}"
-                )
-
-                expected = snapshot_data[start : (None if end is None else end + 1)]
-                actual = r.body.data()
-                assert (
-                    expected == actual
-                ), f"Binary mismatch, {len(expected)} vs {len(actual)}:\n{expected}\nvs\n{actual}"
-
+            ]
+        ] + [
+            (check_negative_offset, negative_offset)
             for negative_offset in [
                 1,
                 a,
                 b,
-            ]:
-                range_header_value = f"-{negative_offset}"
-                r = do_request(
-                    "GET", path, headers={"range": f"bytes={range_header_value}"}
+            ]
+        ]
+
+        # Range requests are independent reads, so spread them across
+        # several concurrent workers, each with its own clients
+        def run_range_checks(checks):
+            with file_request_client() as worker_request:
+                for check, *check_args in checks:
+                    check(worker_request, *check_args)
+
+        concurrent_clients = 4
+        with futures.ThreadPoolExecutor(max_workers=concurrent_clients) as executor:
+            list(
+                executor.map(
+                    run_range_checks,
+                    [
+                        range_checks[i::concurrent_clients]
+                        for i in range(concurrent_clients)
+                    ],
                 )
-                assert r.status_code == http.HTTPStatus.PARTIAL_CONTENT.value, r
+            )
 
-                expected = snapshot_data[-negative_offset:]
-                actual = r.body.data()
-                assert (
-                    expected == actual
-                ), f"Binary mismatch, {len(expected)} vs {len(actual)}:\n{expected}\nvs\n{actual}"
-
-            # Check error handling for invalid ranges
-            for invalid_range, err_msg in [
-                (f"{a}-foo", "Unable to parse end of range value foo"),
-                ("foo-foo", "Unable to parse start of range value foo"),
-                (f"foo-{b}", "Unable to parse start of range value foo"),
-                (f"{b}-{a}", "out of order"),
-                ("-1-5", "Invalid format"),
-                ("-", "Invalid range"),
-                ("-foo", "Unable to parse end of range offset value foo"),
-                ("", "Invalid format"),
-            ]:
-                r = do_request("GET", path, headers={"range": f"bytes={invalid_range}"})
-                assert r.status_code == http.HTTPStatus.BAD_REQUEST.value, r
-                assert err_msg in r.body.json()["error"]["message"], r
+        # Check error handling for invalid ranges
+        for invalid_range, err_msg in [
+            (f"{a}-foo", "Unable to parse end of range value foo"),
+            ("foo-foo", "Unable to parse start of range value foo"),
+            (f"foo-{b}", "Unable to parse start of range value foo"),
+            (f"{b}-{a}", "out of order"),
+            ("-1-5", "Invalid format"),
+            ("-", "Invalid range"),
+            ("-foo", "Unable to parse end of range offset value foo"),
+            ("", "Invalid format"),
+        ]:
+            r = do_request("GET", path, headers={"range": f"bytes={invalid_range}"})
+            assert r.status_code == http.HTTPStatus.BAD_REQUEST.value, r
+            assert err_msg in r.body.json()["error"]["message"], r
+
+    snapshot_view.release()
+    snapshot_data.close()
 
 
 def test_snapshot_repr_digest(network, args):
@@ -924,14 +988,19 @@ def split_all_ledger_files_in_dir(input_dir, output_dir):
     # (so that all files end on a signature that verifies their integrity).
     # We first detect all signature transactions in a ledger file and truncate
     # at any one (but not the last one, which would have no effect) at random.
-    for ledger_file in os.listdir(input_dir):
+    # Split files are written back to input_dir, so list it up front rather
+    # than iterating over a directory that is being modified
+    with os.scandir(input_dir) as it:
+        entries = list(it)
+
+    for entry in entries:
         sig_seqnos = []
 
-        if ledger_file.endswith(ccf.ledger.RECOVERY_FILE_SUFFIX):
+        if entry.name.endswith(ccf.ledger.RECOVERY_FILE_SUFFIX):
             # Ignore recovery files
             continue
 
-        ledger_file_path = os.path.join(input_dir, ledger_file)
+        ledger_file_path = entry.path
         ledger_chunk = ccf.ledger.LedgerChunk(
             ledger_file_path,
         )
@@ -1657,19 +1726,24 @@ def run_config_timeout_check(const_args):
     if infra.platform_detection.is_snp():
         env.update(snp.get_aci_env())
 
-    proc = subprocess.Popen(
-        [
-            os.path.join(".", os.path.basename(node.remote.BIN)),
-            "--config",
-            "0.config.json",
-            "--config-timeout",
-            f"{config_timeout}s",
-        ],
-        cwd=start_node_path,
-        env=env,
-        stdout=open(os.path.join(start_node_path, "out"), "wb"),
-        stderr=open(os.path.join(start_node_path, "err"), "wb"),
-    )
+    # The child process holds its own copies of the descriptors, so the
+    # files can be closed as soon as it has been spawned
+    with open(os.path.join(start_node_path, "out"), "wb") as outf, open(
+        os.path.join(start_node_path, "err"), "wb"
+    ) as errf:
+        proc = subprocess.Popen(
+            [
+                os.path.join(".", os.path.basename(node.remote.BIN)),
+                "--config",
+                "0.config.json",
+                "--config-timeout",
+                f"{config_timeout}s",
+            ],
+            cwd=start_node_path,
+            env=env,
+            stdout=outf,
+            stderr=errf,
+        )
     time.sleep(2)
     LOG.info("Copy a partial config")
     # Replace it with a prefix
@@ -1681,11 +1755,20 @@ def run_config_timeout_check(const_args):
         os.path.join(start_node_path, "0.config.json.bak"),
         os.path.join(start_node_path, "0.config.json"),
     )
-    LOG.info(f"Wait out the rest of the {config_timeout}s timeout")
-    time.sleep(config_timeout)
+    # The node gives no signal while it waits for a valid config, so the
+    # sleeps above are required. Once the full config is parsed, the node
+    # starts up and writes its service certificate, so wait for that
+    # rather than for the whole timeout.
+    LOG.info(f"Wait up to {config_timeout}s for node to start")
+    service_cert_path = os.path.join(start_node_path, "service_cert.pem")
+    start = time.time()
+    while time.time() - start < config_timeout:
+        if os.path.exists(service_cert_path) or proc.poll() is not None:
+            break
+        time.sleep(0.1)
     LOG.info("Check node")
     assert proc.poll() is None, "Node process should still be running"
-    assert os.path.exists(os.path.join(start_node_path, "service_cert.pem"))
+    assert os.path.exists(service_cert_path)
     proc.terminate()
     proc.wait()
 
@@ -1702,12 +1785,16 @@ def run_sighup_check(const_args):
     ) as network:
         network.start_and_open(args)
         network.nodes[0].remote.remote.hangup()
-        time.sleep(5)
+        timeout = 5
+        start = time.time()
+        while time.time() - start < timeout:
+            if network.nodes[0].remote.check_done():
+                break
+            time.sleep(0.1)
         assert network.nodes[0].remote.check_done(), "Node should have exited"
         out, _ = network.nodes[0].remote.get_logs()
         with open(out, "r") as outf:
-            lines = outf.readlines()
-        assert any("SIGHUP: " in line for line in lines), "Hangup should be logged"
+            assert any("SIGHUP: " in line for line in outf), "Hangup should be logged"
 
 
 def run_configuration_file_checks(args):
@@ -1777,7 +1864,8 @@ def run_pid_file_check(args):
             time.sleep(0.1)
         out, _ = node.remote.get_logs()
         with open(out, "r") as outf:
-            last_line = outf.readlines()[-1].strip()
+            # Only keep the last line, rather than reading the whole log
+            last_line = collections.deque(outf, maxlen=1)[0].strip()
         assert last_line.endswith(
             "PID file node.pid already exists. Exiting."
         ), last_line
@@ -2092,6 +2180,9 @@ def run_cose_signatures_config_check(args):
                 assert r.status_code == http.HTTPStatus.OK
                 txid = TxID.from_str(r.body.json()["transaction_id"])
                 max_retries = 10
+                # Back off exponentially, so that signatures which are ready
+                # quickly are not held up, while still waiting ~1s in total
+                retry_delay_s = 0.005
                 for _ in range(max_retries):
                     response = client.get(
                         "/log/public/cose_signature",
@@ -2121,7 +2212,8 @@ def run_cose_signatures_config_check(args):
                         break
                     elif response.status_code == http.HTTPStatus.ACCEPTED:
                         LOG.debug(f"Transaction {txid} accepted, retrying")
-                        time.sleep(0.1)
+                        time.sleep(retry_delay_s)
+                        retry_delay_s = min(retry_delay_s * 2, 0.2)
                     else:
                         LOG.error(f"Failed to get COSE signature for txid {txid}")
                         break
@@ -2,6 +2,7 @@
 # Licensed under the Apache 2.0 License.
 import os
 import http
+import functools
 import infra.member
 import infra.network
 import infra.path
@@ -84,36 +85,38 @@ def test_jinja_templates(network, args, verify=True):
     new_user_local_id = "bob"
     new_user = network.create_user(new_user_local_id, args.participants_curve)
 
+    # User authentication is checked on every request, so a single
+    # connection observes the user being added and then removed
     with primary.client(new_user_local_id) as c:
         r = c.post("/app/log/private", {"id": 42, "msg": "New user test"})
         assert r.status_code == http.HTTPStatus.UNAUTHORIZED.value
 
-    template_loader = jinja2.ChoiceLoader(
-        [
-            jinja2.FileSystemLoader(args.jinja_templates_path),
-            jinja2.FileSystemLoader(os.path.dirname(new_user.cert_path)),
-        ]
-    )
-    template_env = jinja2.Environment(
-        loader=template_loader, undefined=jinja2.StrictUndefined
-    )
+        template_loader = jinja2.ChoiceLoader(
+            [
+                jinja2.FileSystemLoader(args.jinja_templates_path),
+                jinja2.FileSystemLoader(os.path.dirname(new_user.cert_path)),
+            ]
+        )
+        template_env = jinja2.Environment(
+            loader=template_loader, undefined=jinja2.StrictUndefined
+        )
 
-    proposal_template = template_env.get_template("set_user_proposal.json.jinja")
-    proposal_body = proposal_template.render(cert=os.path.basename(new_user.cert_path))
-    proposal = network.consortium.get_any_active_member().propose(
-        primary, proposal_body
-    )
+        proposal_template = template_env.get_template("set_user_proposal.json.jinja")
+        proposal_body = proposal_template.render(
+            cert=os.path.basename(new_user.cert_path)
+        )
+        proposal = network.consortium.get_any_active_member().propose(
+            primary, proposal_body
+        )
 
-    ballot_template = template_env.get_template("ballot.json.jinja")
-    ballot_body = ballot_template.render(**json.loads(proposal_body))
-    network.consortium.vote_using_majority(primary, proposal, ballot_body)
+        ballot_template = template_env.get_template("ballot.json.jinja")
+        ballot_body = ballot_template.render(**json.loads(proposal_body))
+        network.consortium.vote_using_majority(primary, proposal, ballot_body)
 
-    with primary.client(new_user_local_id) as c:
         r = c.post("/app/log/private", {"id": 42, "msg": "New user test"})
         assert r.status_code == http.HTTPStatus.OK.value
 
-    network.consortium.remove_user(primary, new_user.service_id)
-    with primary.client(new_user_local_id) as c:
+        network.consortium.remove_user(primary, new_user.service_id)
         r = c.get("/app/log/private")
         assert r.status_code == http.HTTPStatus.UNAUTHORIZED.value
 
@@ -233,6 +236,14 @@ def test_member_data(network, args):
     return network
 
 
+# Member key files do not change during a run, and are read again when the
+# same members are checked on the recovered network
+@functools.cache
+def read_pem(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
 @reqs.description("Check /gov/service/members endpoint")
 def test_all_members(network, args):
     def run_test_all_members(network):
@@ -264,7 +275,7 @@ def test_all_members(network, args):
                 enc_pub_key_file = os.path.join(
                     primary.common_dir, member.member_info["encryption_public_key_file"]
                 )
-                recovery_enc_key = open(enc_pub_key_file, encoding="utf-8").read()
+                recovery_enc_key = read_pem(enc_pub_key_file)
                 assert response_pub_enc_key == recovery_enc_key
             else:
                 assert response_pub_enc_key is None
@@ -325,8 +336,12 @@ def test_each_node_cert_renewal(network, args):
         (now, validity_period_forbidden, infra.proposal.ProposalNotAccepted),
     ]
 
+    joined_nodes = network.get_joined_nodes()
     for valid_from, validity_period_days, expected_exception in test_vectors:
-        for node in network.get_joined_nodes():
+        # Converted once per vector, rather than on every node and interface
+        # when the node checks its certificate validity period
+        valid_from_x509 = str(infra.crypto.datetime_to_X509time(valid_from))
+        for node in joined_nodes:
             LOG.info(f"Renewing certificate for node {node.local_node_id}")
             for interface_name, rpc_interface in node.host.rpc_interfaces.items():
                 LOG.debug(f"On interface {interface_name}")
@@ -363,7 +378,7 @@ def test_each_node_cert_renewal(network, args):
                             validity_period_days=validity_period_days,
                         )
                         node.set_certificate_validity_period(
-                            valid_from,
+                            valid_from_x509,
                             validity_period_days
                             or args.maximum_node_certificate_validity_days,
                         )
@@ -506,8 +521,9 @@ def test_all_nodes_cert_renewal(network, args, valid_from=None):
     valid_from = valid_from or datetime.now(timezone.utc)
     validity_period_days = args.maximum_node_certificate_validity_days
 
+    joined_nodes = network.get_joined_nodes()
     self_signed_node_certs_before = {}
-    for node in network.get_joined_nodes():
+    for node in joined_nodes:
         # Note: GET /node/self_signed_certificate endpoint was added after 2.0.0-r6
         if CCFVersion(node.version) > CCFVersion("ccf-2.0.0-rc6"):
             self_signed_node_certs_before[node.local_node_id] = (
@@ -523,7 +539,7 @@ def test_all_nodes_cert_renewal(network, args, valid_from=None):
     # Node certificates are updated on global commit hook
     network.wait_for_all_nodes_to_commit(primary)
 
-    for node in network.get_joined_nodes():
+    for node in joined_nodes:
         node.set_certificate_validity_period(valid_from, validity_period_days)
         if CCFVersion(node.version) > CCFVersion("ccf-2.0.0-rc6"):
             assert (
@@ -679,14 +695,15 @@ def single_node(args):
     }
     warn_counts = {k: 0 for k in {validate_warn, apply_warn}}
     out_path, _ = primary.get_logs()
-    for line in open(out_path, "r", encoding="utf-8").readlines():
-        for k in info_counts.keys():
-            if k in line and "[info ]" in line:
-                info_counts[k] += 1
-
-        for k in warn_counts.keys():
-            if k in line and "[fail ]" in line:
-                warn_counts[k] += 1
+    with open(out_path, "r", encoding="utf-8") as outf:
+        for line in outf:
+            for k in info_counts.keys():
+                if k in line and "[info ]" in line:
+                    info_counts[k] += 1
+
+            for k in warn_counts.keys():
+                if k in line and "[fail ]" in line:
+                    warn_counts[k] += 1
 
     LOG.debug("Found following info line occurrences in node output:")
     for k, v in info_counts.items():